@@ -0,0 +1,75 @@
+"""
+Numerical kernels for fio-buffer.  Compiled with Numba when it is installed,
+otherwise plain numpy.
+"""
+
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # pragma: no cover
+    njit = None
+
+
+def _buffer_points_numpy(x, y, distances, circle):
+
+    """
+    Pure numpy version of `buffer_points()`.
+    """
+
+    out = np.empty((len(x), len(circle), 2))
+    out[:, :, 0] = x[:, np.newaxis] + distances[:, np.newaxis] * circle[:, 0]
+    out[:, :, 1] = y[:, np.newaxis] + distances[:, np.newaxis] * circle[:, 1]
+    return out
+
+
+def _buffer_points_loop(x, y, distances, circle):
+
+    """
+    Explicit loop version of `buffer_points()` for Numba to compile.  Not
+    parallelized because `--jobs` already runs one process per core.
+    """
+
+    out = np.empty((len(x), len(circle), 2))
+    for i in range(len(x)):
+        for j in range(len(circle)):
+            out[i, j, 0] = x[i] + distances[i] * circle[j, 0]
+            out[i, j, 1] = y[i] + distances[i] * circle[j, 1]
+    return out
+
+
+if njit is not None:  # pragma: no cover
+    _buffer_points = njit(fastmath=True, cache=True)(_buffer_points_loop)
+else:
+    _buffer_points = _buffer_points_numpy
+
+
+def buffer_points(x, y, distances, circle):
+
+    """
+    Build a ring around each point by scaling and offsetting a unit circle.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        X coordinate of each point.
+    y : numpy.ndarray
+        Y coordinate of each point.
+    distances : numpy.ndarray
+        Radius of each ring.
+    circle : numpy.ndarray
+        Closed ring with a radius of 1 centered on the origin as an (M, 2)
+        array.
+
+    Returns
+    -------
+    numpy.ndarray
+        An (N, M, 2) array of rings.
+    """
+
+    return _buffer_points(
+        np.ascontiguousarray(x, dtype=np.float64),
+        np.ascontiguousarray(y, dtype=np.float64),
+        np.ascontiguousarray(distances, dtype=np.float64),
+        np.ascontiguousarray(circle, dtype=np.float64))
@@ -5,17 +5,21 @@ Core components for fio-buffer
 """
 
 
-import copy
+import collections
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import functools
+import itertools
+import json
 import logging
-from multiprocessing import cpu_count, Pool
+import multiprocessing
+from multiprocessing import cpu_count
+import os
+import queue
+import threading
 
 import click
-import fiona as fio
-from fiona.transform import transform_geom
-from shapely.geometry import CAP_STYLE
-from shapely.geometry import JOIN_STYLE
-from shapely.geometry import mapping
-from shapely.geometry import shape
 
 from . import __version__
 
@@ -24,13 +28,97 @@ logging.basicConfig()
 logger = logging.getLogger('fio-buffer')
 
 
+# Drivers that commit a transaction every time features are written.
+_TRANSACTION_DRIVERS = ('GPKG', 'SQLite')
+
+# Names accepted by `--cap-style` and `--join-style` and their values in
+# Shapely's `CAP_STYLE` and `JOIN_STYLE`.  Spelled out so Shapely isn't
+# imported until geometries are actually buffered.
+CAP_STYLES = {'round': 1, 'flat': 2, 'square': 3}
+JOIN_STYLES = {'round': 1, 'mitre': 2, 'bevel': 3}
+
+# Number of features sent to a worker in a single task.
+_BATCH_SIZE = 128
+
+# Holds the feature processor built by `_init()` in each worker so the
+# processing arguments are only pickled once per process instead of once
+# per feature.
+_WORKER_CTX = {}
+
+
+@functools.lru_cache(maxsize=None)
+def _shapely2():
+
+    """
+    Check if Shapely 2's vectorized functions, like `get_coordinates()`, are
+    available.  Fiona loads every plugin whenever `fio` runs, so Shapely is
+    only imported here, on first use.
+    """
+
+    import shapely
+
+    return hasattr(shapely, 'get_coordinates')
+
+
+@functools.lru_cache(maxsize=None)
+def _enable_speedups():
+
+    """
+    Tell Shapely 1 to use its C extension, which Shapely 2 always uses.
+    """
+
+    if _shapely2():
+        return
+
+    try:  # pragma: no cover
+        from shapely import speedups
+        if speedups.available:
+            speedups.enable()
+    except ImportError:  # pragma: no cover
+        pass
+
+
+@functools.lru_cache(maxsize=None)
+def _geo_interface_write():
+
+    """
+    Check if Fiona converts anything with a `__geo_interface__` when writing,
+    which Fiona 1.9+ does, so buffered geometries can be written without
+    first building a GeoJSON dict.
+    """
+
+    try:
+        from fiona.model import Geometry
+        from shapely.geometry import Polygon
+        return Geometry.from_dict(Polygon()).type == 'Polygon'
+    except Exception:  # pragma: no cover
+        return False
+
+
+@functools.lru_cache(maxsize=None)
+def _orjson():
+
+    """
+    Get the `orjson` module, or `None` if it isn't installed.
+    """
+
+    try:
+        import orjson
+        return orjson
+    except ImportError:  # pragma: no cover
+        return None
+
+
 def _cb_cap_style(ctx, param, value):
 
     """
     Click callback to transform `--cap-style` to an `int`.
     """
 
-    return getattr(CAP_STYLE, value)
+    try:
+        return CAP_STYLES[value]
+    except KeyError:
+        raise click.BadParameter("unknown cap style: {}".format(value))
 
 
 def _cb_join_style(ctx, param, value):
@@ -39,7 +127,10 @@ def _cb_join_style(ctx, param, value):
     Click callback to transform `--join-style` to an `int`.
     """
 
-    return getattr(JOIN_STYLE, value)
+    try:
+        return JOIN_STYLES[value]
+    except KeyError:
+        raise click.BadParameter("unknown join style: {}".format(value))
 
 
 def _cb_res(ctx, param, value):
@@ -66,80 +157,1117 @@ def _cb_dist(ctx, param, value):
         return value
 
 
-def _processor(args):
+def _rings(polygon, arrays=False):
+
+    """
+    Get a polygon's rings as GeoJSON coordinates.  Each ring's coordinates
+    are pulled out of GEOS in a single call rather than point by point, and
+    are only converted to lists if `arrays` is `False`.
+    """
+
+    from shapely import get_coordinates
+
+    include_z = polygon.has_z
+    rings = [
+        get_coordinates(ring, include_z=include_z)
+        for ring in (polygon.exterior,) + tuple(polygon.interiors)]
+    return rings if arrays else [r.tolist() for r in rings]
+
+
+def _mapping(geom, arrays=False):
 
     """
-    Process a single feature.
+    Faster `shapely.geometry.mapping()` for the polygons produced by a buffer
+    operation.  Other geometry types, empty geometries, and Shapely 1 all
+    fall back to `mapping()`.
 
     Parameters
     ----------
-    args : dict
-        feat : dict
-            A GeoJSON feature to process.
-        src_crs : str or dict
-            The geometry's CRS.
-        buf_crs : str or dict
-            Apply buffer after reprojecting to this CRS.
-        dst_crs : str or dict
-            Reproject buffered geometry to this CRS before returning.
-        skip_failures : bool
-            If True then Exceptions don't stop processing.
-        buf_args : dict
-            Keyword arguments for the buffer operation.
+    geom : shapely geometry
+        Geometry to convert.
+    arrays : bool, optional
+        Leave each polygon ring as an (N, 2) or (N, 3) `numpy.ndarray` for
+        serializers that can handle them.
 
     Returns
     -------
     dict
-        GeoJSON feature with updated geometry.
+        GeoJSON geometry.
     """
 
-    feat = args['feat']
-    src_crs = args['src_crs']
-    buf_crs = args['buf_crs']
-    dst_crs = args['dst_crs']
-    skip_failures = args['skip_failures']
-    buf_args = args['buf_args']
+    from shapely.geometry import mapping
+
+    if not _shapely2() or geom.is_empty:
+        return mapping(geom)
+    elif geom.geom_type == 'Polygon':
+        return {'type': 'Polygon', 'coordinates': _rings(geom, arrays)}
+    elif geom.geom_type == 'MultiPolygon':
+        return {
+            'type': 'MultiPolygon',
+            'coordinates': [_rings(p, arrays) for p in geom.geoms]}
+    else:
+        return mapping(geom)
+
+
+def _distance_getter(distance):
+
+    """
+    Build a function that gets a feature's buffer distance, so deciding
+    whether the distance is fixed or comes from a field only happens once.
+
+    Parameters
+    ----------
+    distance : float or str
+        A fixed distance or the name of the field containing the distance.
+
+    Returns
+    -------
+    callable
+        Takes a GeoJSON feature and returns its buffer distance.
+    """
+
+    if isinstance(distance, (float, int)):
+        def get_distance(feat):
+            return distance
+
+    else:
+        def get_distance(feat):
+            return feat['properties'][distance]
+
+    return get_distance
+
+
+def _shape_points(geojsons):
+
+    """
+    Construct Shapely points from GeoJSON point geometries with a single
+    vectorized call.  Much faster than calling `shape()` for each point.
+
+    Parameters
+    ----------
+    geojsons : list
+        GeoJSON geometries.
+
+    Returns
+    -------
+    list or None
+        Shapely points, or `None` if not on Shapely 2 or if any geometry is
+        not a point with a consistent number of dimensions.
+    """
+
+    if not _shapely2():
+        return None
+
+    import shapely
+
+    try:
+        if all(g['type'] == 'Point' for g in geojsons):
+            return list(shapely.points([g['coordinates'] for g in geojsons]))
+    except Exception:
+        pass
+
+    return None
+
+
+def _buffer_points(points, distances, quad_segs):
+
+    """
+    Buffer points with round caps by building regular polygons with
+    `_kernels.buffer_points()` instead of going through GEOS' general purpose
+    buffer algorithm.  The vertices match `shapely.buffer()`.  Requires
+    Shapely 2.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        Shapely points.
+    distances : numpy.ndarray
+        Positive buffer distance for each point.
+    quad_segs : int
+        Number of segments used to approximate a quarter circle.
+
+    Returns
+    -------
+    numpy.ndarray or None
+        Shapely polygons, or `None` if any point is empty or 3D.
+    """
+
+    import numpy as np
+    import shapely
+
+    from . import _kernels
+
+    if shapely.is_empty(points).any() or shapely.has_z(points).any():
+        return None
+
+    # Like GEOS, start at 3 o'clock and go clockwise
+    theta = np.linspace(0, -2 * np.pi, 4 * max(int(quad_segs), 1) + 1)
+    circle = np.column_stack([np.cos(theta), np.sin(theta)])
+    circle[-1] = circle[0]
+
+    centers = shapely.get_coordinates(points)
+    return shapely.polygons(
+        _kernels.buffer_points(centers[:, 0], centers[:, 1], distances, circle))
+
+
+def _has_area(geom):
+
+    """
+    Check if a geometry can have an area.  Geometry collections are assumed
+    to contain polygons.
+    """
+
+    return not geom.is_empty and geom.geom_type in (
+        'Polygon', 'MultiPolygon', 'GeometryCollection')
+
+
+def _fully_eroded(geom, distance):
+
+    """
+    Check if a negative buffer is guaranteed to completely erode a geometry.
+    No part of a geometry is thicker than the narrowest side of its bounding
+    box, so eroding by half of that side or more leaves nothing behind.
+
+    Parameters
+    ----------
+    geom : shapely geometry
+        Geometry to check.
+    distance : float
+        Negative buffer distance.
+
+    Returns
+    -------
+    bool
+    """
+
+    x_min, y_min, x_max, y_max = geom.bounds
+    return -distance >= min(x_max - x_min, y_max - y_min) / 2.0
+
+
+def _is_geographic(crs):
+
+    """
+    Check if a CRS is geographic.  CRS' that can't be checked are assumed to
+    be geographic so their output is still cut at the antimeridian.
+
+    Parameters
+    ----------
+    crs : str or dict or None
+        CRS to check.
+
+    Returns
+    -------
+    bool
+    """
+
+    if not crs:
+        return False
+
+    try:
+        from fiona.crs import CRS
+        return CRS.from_user_input(crs).is_geographic
+    except Exception:
+        return True
+
+
+def _transformer(src_crs, dst_crs):
+
+    """
+    Get a `pyproj.Transformer()` for reprojecting geometries between two CRS'.
+
+    Parameters
+    ----------
+    src_crs : str or dict
+        Reproject from this CRS.
+    dst_crs : str or dict
+        Reproject to this CRS.
+
+    Returns
+    -------
+    pyproj.Transformer or None
+        `None` if pyproj is not installed or if `dst_crs` is geographic, in
+        which case `transform_geom()` is needed for its antimeridian cutting.
+    """
+
+    try:
+        from pyproj import CRS
+    except ImportError:  # pragma: no cover
+        return None
+
+    dst_crs = CRS.from_user_input(dst_crs)
+    if dst_crs.is_geographic:
+        return None
+
+    return _get_transformer(CRS.from_user_input(src_crs), dst_crs)
+
+
+@functools.lru_cache(maxsize=16)
+def _get_transformer(src_crs, dst_crs):
+
+    """
+    Cached `pyproj.Transformer.from_crs()`.  Building a transformer compiles
+    a PROJ pipeline, so each pair of CRS' should only pay for it once.
+
+    Parameters
+    ----------
+    src_crs : pyproj.CRS
+        Reproject from this CRS.
+    dst_crs : pyproj.CRS
+        Reproject to this CRS.
+
+    Returns
+    -------
+    pyproj.Transformer
+    """
+
+    from pyproj import Transformer
+
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+
+def _transform(transformer, geom):
+
+    """
+    Reproject a geometry with a `pyproj.Transformer()`.  On Shapely 2 all of
+    the geometry's coordinates are reprojected in a single call.
+
+    Parameters
+    ----------
+    transformer : pyproj.Transformer
+        Performs the reprojection.
+    geom : shapely geometry
+        Geometry to reproject.
+
+    Returns
+    -------
+    shapely geometry
+    """
+
+    # Coordinates outside of the CRS' domain become `inf` unless checked
+    if not _shapely2():
+        from shapely.ops import transform
+        return transform(functools.partial(transformer.transform, errcheck=True), geom)
+
+    import numpy as np
+    import shapely
+
+    def func(coords):
+        return np.column_stack(
+            transformer.transform(coords[:, 0], coords[:, 1], errcheck=True))
+
+    return shapely.transform(geom, func)
+
+
+def _make_processor(src_crs, buf_crs, dst_crs, skip_failures, buf_args,
+                    fuse_buffers=False, geo_interface=False):
+
+    """
+    Build a function that processes a single feature.  Decisions that only
+    depend on the configuration, like whether a reprojection is needed or
+    where the buffer distance comes from, are made once here instead of
+    once per feature.
+
+    Parameters
+    ----------
+    src_crs : str or dict
+        The geometry's CRS.
+    buf_crs : str or dict
+        Apply buffer after reprojecting to this CRS.
+    dst_crs : str or dict
+        Reproject buffered geometry to this CRS before returning.
+    skip_failures : bool
+        If True then Exceptions don't stop processing.
+    buf_args : dict
+        Keyword arguments for the buffer operation.  The distance is either
+        a number or the name of a field containing the distance.
+    fuse_buffers : bool, optional
+        Buffer features sharing a distance with a single GEOS call when their
+        buffers are disjoint.  Requires Shapely 2.
+    geo_interface : bool, optional
+        Return buffered geometries as Shapely geometries instead of GeoJSON
+        when no reprojection through `transform_geom()` is needed.  Only
+        useful when the consumer accepts `__geo_interface__` objects.
+
+    Returns
+    -------
+    callable
+        Takes a list of GeoJSON features and returns a list containing each
+        feature with a buffered geometry, or `None` if the feature failed and
+        failures are skipped.
+    """
+
+    from fiona.transform import transform_geom
+    import numpy as np
+    import shapely
+    from shapely.geometry import GeometryCollection
+    from shapely.geometry import Polygon
+    from shapely.geometry import shape
+
+    shapely2 = _shapely2()
+    _enable_speedups()
+
+    # Bind everything used per feature to local names, which are cheaper to
+    # look up than globals.
+    to_shape = shape
+    to_geojson = _mapping
+    to_output = (lambda geom: geom) if geo_interface else _mapping
+    transform = _transform
+    reproject = transform_geom
+    has_area = _has_area
+    fully_eroded = _fully_eroded
+    log_exception = logger.exception
+    empty = _mapping(Polygon())
+    vector_buffer = getattr(shapely, 'buffer', None)
+    buffer_points = _buffer_points
+
+    # src_crs -> buf_crs.  Reprojecting between identical CRS' is just
+    # wasted work.
+    fwd = _transformer(src_crs, buf_crs) if src_crs != buf_crs else None
+    if src_crs == buf_crs:
+        def forward(geojson, geom):
+            return geom
+    elif fwd is not None:
+        def forward(geojson, geom):
+            return transform(fwd, geom)
+    else:
+        def forward(geojson, geom):
+            return to_shape(reproject(
+                src_crs, buf_crs, geojson,
+                antimeridian_cutting=True
+            ))
+
+    # buf_crs -> dst_crs.  Geographic output is cut at the antimeridian by
+    # `transform_geom()` even when no reprojection is needed, but only
+    # geometries extending past it need to take that path.
+    rev = _transformer(buf_crs, dst_crs) if buf_crs != dst_crs else None
+    if buf_crs == dst_crs and _is_geographic(dst_crs):
+        def reverse(geom):
+            x_min, _, x_max, _ = geom.bounds
+            if x_min < -180 or x_max > 180:
+                return reproject(
+                    buf_crs, dst_crs, to_geojson(geom),
+                    antimeridian_cutting=True
+                )
+            return to_output(geom)
+    elif buf_crs == dst_crs:
+        def reverse(geom):
+            return to_output(geom)
+    elif rev is not None:
+        def reverse(geom):
+            return to_output(transform(rev, geom))
+    else:
+        def reverse(geom):
+            return reproject(
+                buf_crs, dst_crs, to_geojson(geom),
+                antimeridian_cutting=True
+            )
+
+    def forward_many(geojsons, geoms):
+        if src_crs == buf_crs:
+            return geoms
+        elif fwd is not None:
+            return transform(fwd, geoms)
+        return [forward(gj, g) for gj, g in zip(geojsons, geoms)]
+
+    def reverse_many(geoms):
+        if rev is not None:
+            return [to_output(g) for g in transform(rev, geoms)]
+        return [reverse(g) for g in geoms]
+
+    # The distance varies per feature so it is passed separately from the
+    # other buffer arguments, which are shared and must not be modified.
+    buf_kwargs = {k: v for k, v in buf_args.items() if k != 'distance'}
+    if shapely2:
+        buf_kwargs['quad_segs'] = buf_kwargs.pop('resolution', 16)
+
+    # Round buffers around points are just regular polygons
+    round_caps = buf_kwargs.get('cap_style', CAP_STYLES['round']) in (CAP_STYLES['round'], 'round')
+
+    def process(feat, distance, geom=None):
+        try:
+            if geom is None:
+                geom = to_shape(feat['geometry'])
+
+            # Skip all the work for geometries that are guaranteed to disappear
+            if distance <= 0 and not has_area(geom):
+                return dict(feat, geometry=empty)
+
+            geom = forward(feat['geometry'], geom)
+
+            # Erosion can only be checked once the geometry is in the buffer CRS
+            if distance < 0 and fully_eroded(geom, distance):
+                return dict(feat, geometry=empty)
+
+            return dict(feat, geometry=reverse(geom.buffer(distance, **buf_kwargs)))
+
+        except Exception:
+            log_exception("Feature with ID %s failed during buffering", feat.get('id'))
+            if not skip_failures:
+                raise
 
     # Support buffering by a field's value
-    if not isinstance(buf_args['distance'], (float, int)):
-        field_val = feat['properties'][buf_args['distance']]
+    get_distance = _distance_getter(buf_args['distance'])
 
+    def processor(feat, distance, geom=None):
         # Buffering according to a field but field is None so just return the feature
-        if field_val is None:
+        if distance is None:
             return feat
-        else:
-            buf_args['distance'] = field_val
+        return process(feat, distance, geom)
+
+    def process_batch(batch):
+        geoms = _shape_points([f['geometry'] for f in batch]) or [None] * len(batch)
+        return [
+            processor(feat, get_distance(feat), geom) for feat, geom in zip(batch, geoms)]
+
+    def buffer_many(batch, distances):
+
+        """
+        Buffer features with a single call to each of Shapely 2's vectorized
+        functions.  Any failure fails the entire batch.
+        """
+
+        geojsons = [f['geometry'] for f in batch]
+        points = _shape_points(geojsons)
+        geoms = points if points is not None else [to_shape(g) for g in geojsons]
+        geoms = np.array(forward_many(geojsons, np.array(geoms, dtype=object)), dtype=object)
+
+        buffered = None
+        if points is not None and round_caps:
+            buffered = buffer_points(geoms, distances, buf_kwargs['quad_segs'])
+        if buffered is None:
+            buffered = vector_buffer(geoms, distances, **buf_kwargs)
+        return [
+            dict(feat, geometry=geom) for feat, geom in zip(batch, reverse_many(buffered))]
+
+    def process_batch_vectorized(batch):
+        out = [None] * len(batch)
+        indexes = []
+        distances = []
+        for idx, feat in enumerate(batch):
+            distance = get_distance(feat)
+
+            # Non-positive distances benefit more from the shortcuts in
+            # `process()`, which are per feature.
+            if distance is not None and distance > 0:
+                indexes.append(idx)
+                distances.append(distance)
+            else:
+                out[idx] = processor(feat, distance)
+
+        if indexes:
+            group = [batch[i] for i in indexes]
+            try:
+                processed = buffer_many(group, np.array(distances, dtype=np.float64))
+            except Exception:
+                # Process individually so only the failing features fail
+                logger.debug("Batch failed, processing features individually", exc_info=True)
+                processed = [processor(feat, d) for feat, d in zip(group, distances)]
+            for idx, o_feat in zip(indexes, processed):
+                out[idx] = o_feat
+
+        return out
+
+    def fuse(batch, distance):
+
+        """
+        Buffer features sharing a distance with a single GEOS call.  Returns
+        `None` unless every input maps to exactly one disjoint output polygon.
+        """
+
+        try:
+            geojsons = [f['geometry'] for f in batch]
+            geoms = _shape_points(geojsons) or [shape(g) for g in geojsons]
+            geoms = [forward(gj, g) for gj, g in zip(geojsons, geoms)]
+            fused = GeometryCollection(geoms).buffer(distance, **buf_kwargs)
+            parts = list(getattr(fused, 'geoms', [fused]))
+            if len(parts) != len(geoms):
+                return None
+
+            # Every input must touch exactly one part and every part exactly
+            # one input.  Otherwise an input buffered into several parts, or
+            # buffers that merged, could be assigned the wrong geometry.
+            tree = shapely.STRtree(parts)
+            inputs, matches = tree.query(geoms, predicate='intersects')
+            if (len(inputs) != len(geoms) or len(set(inputs)) != len(geoms)
+                    or len(set(matches)) != len(parts)):
+                return None
+            order = [None] * len(geoms)
+            for i, m in zip(inputs, matches):
+                order[i] = m
+
+            return [
+                dict(feat, geometry=reverse(parts[m])) for feat, m in zip(batch, order)]
+
+        except Exception:
+            logger.debug("Could not fuse buffers, falling back", exc_info=True)
+            return None
+
+    def process_batch_fused(batch):
+        out = [None] * len(batch)
+        groups = collections.defaultdict(list)
+        for idx, feat in enumerate(batch):
+            distance = get_distance(feat)
+
+            # Erosion can merge or remove parts, so only fuse dilations
+            if distance is not None and distance > 0:
+                groups[distance].append(idx)
+            else:
+                out[idx] = processor(feat, distance)
+
+        for distance, indexes in groups.items():
+            group = [batch[i] for i in indexes]
+            processed = fuse(group, distance) if len(group) > 1 else None
+            if processed is None:
+                processed = [processor(feat, distance) for feat in group]
+            for idx, o_feat in zip(indexes, processed):
+                out[idx] = o_feat
+
+        return out
+
+    if fuse_buffers:
+        return process_batch_fused
+    elif shapely2:
+        return process_batch_vectorized
+    else:
+        return process_batch
+
+
+def _init(src_crs, buf_crs, dst_crs, skip_failures, buf_args, fuse_buffers=False,
+          geo_interface=False, gdal_env=None):
+
+    """
+    Worker initializer.  Builds the worker's feature processor once so the
+    task stream only has to carry the features.  See `_make_processor()` for
+    a description of the arguments.  `gdal_env` holds the GDAL configuration
+    options features are processed with, typically `fiona.env.getenv()` from
+    the main process, since workers don't inherit its `fiona.Env()`.
+    """
+
+    _WORKER_CTX.clear()
+    _WORKER_CTX['processor'] = _make_processor(
+        src_crs, buf_crs, dst_crs, skip_failures, buf_args, fuse_buffers,
+        geo_interface)
+    _WORKER_CTX['gdal_env'] = gdal_env
+
+
+def _processor_batch(batch):
+
+    """
+    Process a batch of features.  On Shapely 2 features with a positive
+    distance are buffered with a single call to `shapely.buffer()`.
+    Requires `_init()`.
+
+    Parameters
+    ----------
+    batch : list
+        GeoJSON features to process.
+
+    Returns
+    -------
+    list
+        GeoJSON features with updated geometries.  Failed features are
+        `None` when skipping failures.
+    """
+
+    gdal_env = _WORKER_CTX.get('gdal_env')
+    if gdal_env is None:
+        return _WORKER_CTX['processor'](batch)
+
+    import fiona
+    with fiona.Env(**gdal_env):
+        return _WORKER_CTX['processor'](batch)
+
+
+def _processor(feat):
+
+    """
+    Process a single feature.  Requires `_init()`.
+
+    Parameters
+    ----------
+    feat : dict
+        A GeoJSON feature to process.
+
+    Returns
+    -------
+    dict
+        GeoJSON feature with updated geometry.
+    """
+
+    return _processor_batch([feat])[0]
+
+
+def _chunked(iterable, n):
+
+    """
+    Group an iterable into lists containing `n` items.  The final list may
+    contain fewer items.
+
+    Parameters
+    ----------
+    iterable : iter
+        Items to group.
+    n : int
+        Maximum number of items per group.
+
+    Yields
+    ------
+    list
+    """
+
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, n))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _available_cpus():
+
+    """
+    Get the number of CPUs this process may run on, which can be fewer than
+    the host has in a container or under CPU affinity limits.
+
+    Returns
+    -------
+    int
+    """
 
     try:
-        # src_crs -> buf_crs
-        reprojected = transform_geom(
-            src_crs, buf_crs, feat['geometry'],
-            antimeridian_cutting=True
-        )
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # pragma: no cover
+        return cpu_count()
 
-        # buffering operation
-        buffered = shape(reprojected).buffer(**buf_args)
 
-        # buf_crs -> dst_crs
-        feat['geometry'] = transform_geom(
-            buf_crs, dst_crs, mapping(buffered),
-            antimeridian_cutting=True
-        )
+def _mp_context():
 
-        return feat
+    """
+    Get a multiprocessing context for the worker pool.  Workers are started
+    while `_read_ahead()` threads are inside Fiona and GDAL, so forking would
+    copy locks held by those threads into the workers.  A fork server or
+    fresh interpreters avoid this.
 
-    except Exception:
-        logger.exception("Feature with ID %s failed during buffering", feat.get('id'))
-        if not skip_failures:
+    Returns
+    -------
+    multiprocessing.context.BaseContext
+    """
+
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def _read_ahead(iterable, maxsize):
+
+    """
+    Iterate over an iterable in a background thread.  Up to `maxsize` items
+    are produced ahead of the consumer, so the two can overlap.  Fiona and
+    GDAL release the GIL during much of their I/O.
+
+    Exceptions raised while iterating are re-raised in the consumer.  If the
+    consumer stops early the background thread stops too and closes the
+    iterable if possible.
+
+    Parameters
+    ----------
+    iterable : iter
+        Items to produce.
+    maxsize : int
+        Maximum number of items waiting to be consumed.
+
+    Yields
+    ------
+    object
+        Items from `iterable`.
+    """
+
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    break
+            else:
+                put((done, None))
+        except BaseException as e:
+            put((done, e))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item, exception = items.get()
+            if item is done:
+                if exception is not None:
+                    raise exception
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _batch_size(src, jobs):
+
+    """
+    Determine how many features to send to a worker in a single task.  Small
+    inputs are split into enough batches to keep all workers busy, larger
+    inputs use `_BATCH_SIZE`.
+
+    Parameters
+    ----------
+    src : iter
+        Features to process.  Sized with `len()` if possible.
+    jobs : int
+        Number of worker processes.
+
+    Returns
+    -------
+    int
+    """
+
+    try:
+        total = len(src)
+    except TypeError:
+        return _BATCH_SIZE
+
+    return max(1, min(_BATCH_SIZE, total // (jobs * 8)))
+
+
+def _strip(feat, field=None):
+
+    """
+    Reduce a feature to what a worker needs to process it: its ID, geometry,
+    and the field containing the buffer distance, if any.  Everything else
+    stays in the main process instead of being pickled to and from a worker.
+
+    Parameters
+    ----------
+    feat : dict
+        GeoJSON feature.
+    field : str, optional
+        Name of the field containing the buffer distance.
+
+    Returns
+    -------
+    dict
+    """
+
+    return {
+        'id': feat.get('id'),
+        'geometry': feat['geometry'],
+        'properties': {field: feat['properties'][field]} if field is not None else {}
+    }
+
+
+def _json_default(obj):
+
+    """
+    Serialize objects the JSON encoder doesn't know about, like Shapely
+    geometries and Fiona's feature models.  orjson serializes the
+    coordinate arrays of Shapely polygons without converting them to lists.
+    """
+
+    from shapely.geometry.base import BaseGeometry
+
+    if isinstance(obj, BaseGeometry):
+        return _mapping(obj, arrays=_orjson() is not None)
+    elif hasattr(obj, '__geo_interface__'):
+        return obj.__geo_interface__
+    elif isinstance(obj, Mapping):
+        return dict(obj)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+def _dumps(obj):
+
+    """
+    Serialize an object to compact JSON bytes with `orjson` if it is
+    installed, and `json` otherwise.
+    """
+
+    orjson = _orjson()
+    if orjson is not None:
+        return orjson.dumps(obj, default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, default=_json_default, separators=(',', ':')).encode('utf-8')
+
+
+def _dump_feature(feat):
+
+    """
+    Serialize a feature like GDAL's GeoJSON drivers do, which don't write
+    the feature's ID.
+    """
+
+    return _dumps({
+        'type': 'Feature',
+        'properties': feat['properties'],
+        'geometry': feat['geometry']
+    })
+
+
+def _geojson_crs(crs):
+
+    """
+    Get the `crs` member GDAL writes to a GeoJSON file.
+
+    Parameters
+    ----------
+    crs : str or dict
+        Output CRS.
+
+    Raises
+    ------
+    ValueError
+        If the CRS can't be referenced by an authority and code.
+
+    Returns
+    -------
+    dict
+    """
+
+    from fiona.crs import CRS as FionaCRS
+    authority = FionaCRS.from_user_input(crs).to_authority()
+    if not authority:
+        raise ValueError("CRS has no authority: {}".format(crs))
+    elif authority == ('EPSG', '4326'):
+        name = 'urn:ogc:def:crs:OGC:1.3:CRS84'
+    else:
+        name = 'urn:ogc:def:crs:{}::{}'.format(*authority)
+    return {'type': 'name', 'properties': {'name': name}}
+
+
+@contextlib.contextmanager
+def _open_output(path):
+
+    """
+    Open a binary file for writing that is removed if writing fails, so an
+    error never leaves behind truncated output.  `-` is stdout.
+
+    Parameters
+    ----------
+    path : str
+        File to write.
+
+    Yields
+    ------
+    file
+    """
+
+    with click.open_file(path, 'wb') as fh:
+        try:
+            yield fh
+        except BaseException:
+            if path != '-':
+                fh.close()
+                os.remove(path)
             raise
 
 
+def _write_geojson(fh, features, crs, batch_size=1000):
+
+    """
+    Write features as a GeoJSON FeatureCollection.  Much faster than Fiona's
+    GeoJSON driver, which spends most of its time formatting coordinates.
+
+    Parameters
+    ----------
+    fh : file
+        Binary file to write to.
+    features : iterable
+        Features to write.  Geometries can be GeoJSON or objects with a
+        `__geo_interface__`.
+    crs : dict
+        The collection's `crs` member.  See `_geojson_crs()`.
+    batch_size : int, optional
+        Number of features to join into a single write.
+    """
+
+    fh.write(b'{"type":"FeatureCollection","crs":' + _dumps(crs) + b',"features":[\n')
+    sep = b''
+    for batch in _chunked(features, batch_size):
+        fh.write(sep + b',\n'.join(_dump_feature(feat) for feat in batch))
+        sep = b',\n'
+    fh.write(b'\n]}\n')
+
+
+def _write_seq(fh, features, batch_size=1000):
+
+    """
+    Write features as a GeoJSON text sequence (RFC 7464 and RFC 8142).  Each
+    feature is written as soon as it is produced, so memory use doesn't grow
+    with the number of features.
+
+    Parameters
+    ----------
+    fh : file
+        Binary file to write to.
+    features : iterable
+        Features to write.  Geometries can be GeoJSON or objects with a
+        `__geo_interface__`.
+    batch_size : int, optional
+        Number of features to join into a single write.
+    """
+
+    for batch in _chunked(features, batch_size):
+        fh.write(b''.join(
+            b'\x1e' + _dump_feature(feat) + b'\n' for feat in batch))
+
+
+def _as_multipolygon(feat):
+
+    """
+    Wrap a feature's Polygon in a MultiPolygon so it can be written to a
+    MultiPolygon layer, which Fiona checks strictly.  Other geometries are
+    left alone.
+
+    Parameters
+    ----------
+    feat : dict
+        GeoJSON feature.  The geometry can be GeoJSON or a Shapely geometry.
+
+    Returns
+    -------
+    dict
+    """
+
+    geom = feat['geometry']
+    if isinstance(geom, Mapping):
+        if geom.get('type') != 'Polygon':
+            return feat
+        geom = {'type': 'MultiPolygon', 'coordinates': [geom['coordinates']]}
+    elif getattr(geom, 'geom_type', None) == 'Polygon':
+        from shapely.geometry import MultiPolygon
+        geom = MultiPolygon([geom])
+    else:
+        return feat
+    return dict(feat, geometry=geom)
+
+
+def _process_batch(batch):
+
+    """
+    Process a batch of features with `_processor_batch()`, only keeping the
+    geometries.  Requires `_init()`.
+
+    Parameters
+    ----------
+    batch : list
+        GeoJSON features to process, typically reduced with `_strip()`.
+
+    Returns
+    -------
+    list
+        Only the geometry of each processed feature.  Failed features are
+        `None` when skipping failures.
+    """
+
+    return [
+        None if o_feat is None else o_feat['geometry']
+        for o_feat in _processor_batch(batch)]
+
+
+def _merge(batch, geoms, has_distance):
+
+    """
+    Put the geometries returned by `_process_batch()` back into the features
+    they came from.
+
+    Parameters
+    ----------
+    batch : list
+        Original GeoJSON features.
+    geoms : list
+        Geometries for the features in `batch` with a buffer distance.
+    has_distance : callable
+        Checks if a feature has a buffer distance.  Features without one are
+        passed through unaltered.
+
+    Returns
+    -------
+    list
+        Buffered features.  Features that failed and were skipped are
+        dropped.
+    """
+
+    geoms = iter(geoms)
+    o_batch = []
+    for feat in batch:
+        if not has_distance(feat):
+            o_batch.append(feat)
+            continue
+        geom = next(geoms)
+        if geom is not None:
+            o_batch.append(dict(feat, geometry=geom))
+    return o_batch
+
+
+def _pool_results(executor, batches, prefetch, has_distance, field=None):
+
+    """
+    Process batches of features in a pool of workers initialized with
+    `_init()`.  Only the parts of each feature a worker needs are sent to it,
+    and at most `prefetch` batches are in flight so reading, processing, and
+    writing overlap without holding the entire input in memory.
+
+    Parameters
+    ----------
+    executor : concurrent.futures.Executor
+        Worker pool.
+    batches : iter
+        Lists of GeoJSON features.
+    prefetch : int
+        Maximum number of batches submitted but not yet collected.
+    has_distance : callable
+        Checks if a feature has a buffer distance.
+    field : str, optional
+        Name of the field containing the buffer distance.
+
+    Yields
+    ------
+    list
+        Buffered features, one list per batch in the order they were read.
+    """
+
+    def collect():
+        batch, future = pending.popleft()
+        return _merge(batch, future.result(), has_distance)
+
+    pending = collections.deque()
+    for batch in batches:
+        if len(pending) >= prefetch:
+            yield collect()
+        tasks = [_strip(feat, field) for feat in batch if has_distance(feat)]
+        pending.append((batch, executor.submit(_process_batch, tasks)))
+
+    while pending:
+        yield collect()
+
+
 @click.command(short_help="Buffer geometries on all sides by a fixed distance.")
 @click.version_option(prog_name='fio-buffer', version=__version__)
 @click.argument('infile', required=True)
 @click.argument('outfile', required=True)
 @click.option(
-    '-f', '--format', '--driver', metavar='NAME',
+    '-f', '--format', '--driver', 'driver', metavar='NAME',
     help="Output driver name.  Derived from the input datasource if not given."
 )
 @click.option(
@@ -186,14 +1314,40 @@ def _processor(args):
     help="Skip geometries that fail somewhere in the processing pipeline."
 )
 @click.option(
-    '--jobs', type=click.IntRange(1, cpu_count()), default=1,
-    metavar="CORES", show_default=True,
-    help="Process geometries in parallel across N cores.  Feature ID's and order are not "
-         "preserved if more that 1 cores are used."
+    '--jobs', type=click.IntRange(1, _available_cpus()), metavar="CORES",
+    help="Process geometries in parallel across N cores.  Feature ID's and order are "
+         "preserved.  [default: all available cores]"
+)
+@click.option(
+    '--prefetch', type=click.IntRange(1, None), metavar='BATCHES',
+    help="Maximum number of batches of features waiting to be processed or "
+         "written.  [default: 4 * --jobs]"
+)
+@click.option(
+    '--write-batch', type=click.IntRange(1, None), default=1000,
+    metavar='FEATURES', show_default=True,
+    help="Write this many features to the output datasource at a time."
+)
+@click.option(
+    '--no-transaction', 'transaction', is_flag=True, default=True, flag_value=False,
+    help="Commit GPKG and SQLite output every --write-batch features instead of "
+         "handing the whole stream to Fiona, which commits in large transactions "
+         "of its own."
+)
+@click.option(
+    '--seq', is_flag=True,
+    help="Write a GeoJSON text sequence (RFC 8142) directly instead of going through "
+         "Fiona.  --driver and --geom-type are ignored and the output CRS is not recorded."
+)
+@click.option(
+    '--fuse-buffers', is_flag=True,
+    help="Buffer features sharing a distance in a single operation when their buffers "
+         "don't overlap.  Requires Shapely 2."
 )
 @click.pass_context
 def buffer(ctx, infile, outfile, driver, cap_style, join_style, res, mitre_limit,
-           distance, src_crs, buf_crs, dst_crs, output_geom_type, skip_failures, jobs):
+           distance, src_crs, buf_crs, dst_crs, output_geom_type, skip_failures, jobs,
+           prefetch, write_batch, transaction, seq, fuse_buffers):
 
     """
     Geometries can be dilated with a positive distance, eroded with a negative
@@ -240,6 +1394,11 @@ def buffer(ctx, infile, outfile, driver, cap_style, join_style, res, mitre_limit
     if dst_crs and not buf_crs:
         raise click.ClickException("Must specify --buf-crs when using --dst-crs.")
 
+    import fiona as fio
+
+    if fuse_buffers and not _shapely2():
+        raise click.ClickException("--fuse-buffers requires Shapely 2.")
+
     # fio has a -v flag so just use that to set the logging level
     # Extra checks are so this plugin doesn't just completely crash due
     # to upstream changes.
@@ -258,22 +1417,52 @@ def buffer(ctx, infile, outfile, driver, cap_style, join_style, res, mitre_limit
             raise click.ClickException(
                 "CRS is not set in input file.  Use --src-crs to specify.")
 
+        # Catch a bad distance field before processing instead of failing on
+        # every feature.
+        if not isinstance(distance, (float, int)):
+            field_type = src.schema['properties'].get(distance)
+            if field_type is None:
+                raise click.BadParameter(
+                    "not a number or a field in the input file: {}".format(distance),
+                    param_hint='--distance')
+            elif not field_type.startswith(('int', 'float')):
+                raise click.BadParameter(
+                    "field {} has non-numeric type: {}".format(distance, field_type),
+                    param_hint='--distance')
+
         logger.debug("src_crs=%s", src_crs)
         logger.debug("buf_crs=%s", buf_crs)
         logger.debug("dst_crs=%s", dst_crs)
 
-        meta = copy.deepcopy(src.meta)
-        meta.update(
-            driver=driver or src.driver,
-            crs=dst_crs
-        )
+        # Only the schema's geometry type is modified so a shallow copy is
+        # sufficient.
+        meta = {
+            'driver': driver or src.driver,
+            'crs': dst_crs,
+            'schema': dict(src.schema)
+        }
         if output_geom_type:
-            meta['schema'].update(geometry=output_geom_type)
+            meta['schema']['geometry'] = output_geom_type
+
+        # Fiona's GeoJSON driver is slow, so GeoJSON with plain properties is
+        # written directly.
+        geojson_crs = None
+        if (meta['driver'] == 'GeoJSON' and not seq and not outfile.startswith('/vsi')
+                and all(t.startswith(('int', 'float', 'str'))
+                        for t in meta['schema']['properties'].values())):
+            try:
+                geojson_crs = _geojson_crs(dst_crs)
+            except Exception:
+                logger.debug("Writing GeoJSON with Fiona", exc_info=True)
 
         logger.debug("Creating output file %s", outfile)
-        logger.debug("Meta=%s", meta)
+        if seq or geojson_crs:
+            sink = _open_output(outfile)
+        else:
+            logger.debug("Meta=%s", meta)
+            sink = fio.open(outfile, 'w', **meta)
 
-        with fio.open(outfile, 'w', **meta) as dst:
+        with sink as dst:
 
             # Keyword arguments for `<Geometry>.buffer()`
             buf_args = {
@@ -284,26 +1473,111 @@ def buffer(ctx, infile, outfile, driver, cap_style, join_style, res, mitre_limit
                 'mitre_limit': mitre_limit
             }
 
-            # A generator that produces the arguments required for `_processor()`
-            task_generator = (
-                {
-                    'feat': feat,
-                    'src_crs': src_crs,
-                    'buf_crs': buf_crs,
-                    'dst_crs': dst_crs,
-                    'skip_failures': skip_failures,
-                    'buf_args': buf_args
-                } for feat in src)
-
+            # Features without a distance are written unaltered, so they are
+            # held back in the main process instead of round tripping
+            # through a worker.
+            field = None if isinstance(distance, (float, int)) else distance
+            get_distance = _distance_getter(distance)
+
+            def has_distance(feat):
+                return get_distance(feat) is not None
+
+            # Both Fiona and the direct writers accept Shapely geometries
+            geo_interface = _geo_interface_write() or seq or bool(geojson_crs)
+
+            # Features are processed with the GDAL configuration the input
+            # was opened with, whether in this process or in a worker.  The
+            # configuration is thread local so it's captured here.
+            gdal_env = fio.env.getenv() if fio.env.hasenv() else None
+
+            def results():
+
+                """
+                Features are sent to the workers in batches and the arguments
+                shared by every feature are only sent once per worker.
+                Batches are produced in the order they were read.
+                """
+
+                batches = _read_ahead(_chunked(src, _batch_size(src, jobs)), prefetch)
+
+                # A single worker process would only add overhead
+                if jobs == 1:
+                    _init(src_crs, buf_crs, dst_crs, skip_failures, buf_args, fuse_buffers,
+                          geo_interface, gdal_env)
+                    for batch in batches:
+                        tasks = [feat for feat in batch if has_distance(feat)]
+                        yield _merge(batch, _process_batch(tasks), has_distance)
+                    return
+
+                with ProcessPoolExecutor(
+                        jobs, mp_context=_mp_context(), initializer=_init,
+                        initargs=(src_crs, buf_crs, dst_crs, skip_failures, buf_args,
+                                  fuse_buffers, geo_interface, gdal_env)
+                ) as executor:
+                    yield from _pool_results(executor, batches, prefetch, has_distance, field)
+
+            jobs = jobs or _available_cpus()
+            prefetch = prefetch or 4 * jobs
             logger.debug("Starting processing on %s cores", jobs)
-            for o_feat in Pool(jobs).imap_unordered(_processor, task_generator):
-                if o_feat is not None:
+
+            # Reading, submitting and collecting batches, and writing each
+            # happen in their own thread.
+            o_feats = itertools.chain.from_iterable(_read_ahead(results(), prefetch))
+
+            # Buffers are usually polygons but the default output geometry
+            # type is MultiPolygon.
+            if not (seq or geojson_crs) and meta['schema']['geometry'] == 'MultiPolygon':
+                o_feats = map(_as_multipolygon, o_feats)
+
+            if seq:
+                logger.debug("Writing a GeoJSON text sequence")
+                _write_seq(dst, o_feats, write_batch)
+
+            elif geojson_crs:
+                logger.debug("Writing GeoJSON directly")
+                _write_geojson(dst, o_feats, geojson_crs, write_batch)
+
+            # A failed batch can't be partially retried, so features are
+            # written individually when skipping failures.
+            elif skip_failures:
+                for o_feat in o_feats:
                     try:
                         dst.write(o_feat)
                     except Exception:
                         logger.exception(
                             "Feature with ID %s failed during write", o_feat.get('id'))
-                        if not skip_failures:
-                            raise
+
+            # Every write is a transaction for some drivers, so hand them
+            # everything at once and let Fiona manage the transactions for the
+            # whole stream.
+            elif transaction and meta['driver'] in _TRANSACTION_DRIVERS:
+                logger.debug("Writing all features in one stream")
+
+                # Track the feature being written so a failure can be reported
+                last = {}
+
+                def track(feats):
+                    for feat in feats:
+                        last['feat'] = feat
+                        yield feat
+
+                try:
+                    dst.writerecords(track(o_feats))
+                except Exception:
+                    logger.exception(
+                        "Feature with ID %s failed during write",
+                        last.get('feat', {}).get('id'))
+                    raise
+
+            # Otherwise write in batches to amortize the per-write cost of
+            # the driver.
+            else:
+                for out_batch in _chunked(o_feats, write_batch):
+                    try:
+                        dst.writerecords(out_batch)
+                    except Exception:
+                        logger.exception(
+                            "Batch of %s features failed during write", len(out_batch))
+                        raise
 
             logger.debug("Finished processing.")
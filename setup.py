@@ -42,9 +42,13 @@ setup(
         'Intended Audience :: Information Technology',
         'Intended Audience :: Science/Research',
         'License :: OSI Approved :: BSD License',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Topic :: Scientific/Engineering :: GIS'
     ],
     description="A Fiona CLI plugin for buffering geometries.",
@@ -53,11 +57,13 @@ setup(
         buffer=fio_buffer.core:buffer
     """,
     extras_require={
-        'dev': ['pytest', 'pytest-cov']
+        'dev': ['pytest', 'pytest-cov'],
+        'speedups': ['numba', 'pyproj>=2.1']
     },
     include_package_data=True,
     install_requires=[
         'click>=0.3',
+        'numpy',
         'shapely',
         'fiona>=1.6'
     ],
@@ -66,6 +72,7 @@ setup(
     long_description=readme,
     name='fio-buffer',
     packages=find_packages(),
+    python_requires='>=3.7',
     url=source,
     version=version,
     zip_safe=True
@@ -0,0 +1,31 @@
+from click.testing import CliRunner
+import fiona as fio
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope='session')
+def points_meta():
+    # Driver, CRS, and schema of the points test data
+    with fio.open('tests/data/points.geojson') as src:
+        return src.meta
+
+
+@pytest.fixture(scope='session')
+def points():
+    # Features from the points test data, which must not be modified
+    with fio.open('tests/data/points.geojson') as src:
+        return list(src)
+
+
+@pytest.fixture(scope='session')
+def runner():
+    return CliRunner()
+
+
+@pytest.fixture(scope='session')
+def fixed7():
+    # Coordinates rounded to 7 decimal places as integers for exact comparisons
+    def fixed7(coords):
+        return np.rint(np.asarray(coords) * 1e7).astype(np.int64)
+    return fixed7
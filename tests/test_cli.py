@@ -1,63 +1,68 @@
-from click.testing import CliRunner
+import json
+import subprocess
+import sys
+
 import fiona as fio
 import fiona.fio.main
 from fiona.transform import transform_geom
+import numpy as np
+import pytest
 
+import shapely
 from shapely.geometry import mapping
 from shapely.geometry import shape
 
 import fio_buffer.core
 
 
-def test_standard(tmpdir):
+def buffer_all(features, distances):
+    # Expected buffers for every feature with a single vectorized call, cut at
+    # the antimeridian like all geographic output
+    pytest.importorskip('shapely', minversion='2')
+    geoms = shapely.from_geojson(
+        [json.dumps(f['geometry'].__geo_interface__) for f in features])
+    return [
+        shape(transform_geom(
+            'EPSG:4326', 'EPSG:4326', mapping(g), antimeridian_cutting=True))
+        for g in shapely.buffer(geoms, distances, quad_segs=16)]
+
+
+def test_standard(tmpdir, runner, points):
     outfile = str(tmpdir.mkdir('out').join("buf-1.geojson"))
-    result = CliRunner().invoke(fio_buffer.core.buffer, [
+    result = runner.invoke(fio_buffer.core.buffer, [
         'tests/data/points.geojson',
         outfile,
         '--distance', '1',
         '--driver', 'GeoJSON'
     ])
     assert result.exit_code == 0
-    with fio.open('tests/data/points.geojson') as points, fio.open(outfile) as actual:
-        for pnt, buf in zip(points, actual):
-            e_coords = mapping(shape(pnt['geometry']).buffer(1))['coordinates'][0]
-            a_coords = buf['geometry']['coordinates'][0]
-            for e_pair, a_pair in zip(e_coords, a_coords):
-
-                # Multipolygons can creep in and mess up the test so just skip them
-                if buf['geometry']['type'] == 'Polygon':
-                    e_x, e_y = e_pair
-                    a_x, a_y = a_pair
-                    assert round(e_x, 3) == round(a_x, 3)
-                    assert round(e_y, 3) == round(a_y, 3)
+    with fio.open(outfile) as actual:
+        for expected, buf in zip(buffer_all(points, 1), actual):
+            e_coords = shapely.get_coordinates(expected)
+            a_coords = shapely.get_coordinates(shape(buf['geometry']))
+            np.testing.assert_allclose(a_coords, e_coords, rtol=0, atol=1e-3)
 
 
-def test_distance_field(tmpdir):
+def test_distance_field(tmpdir, runner, points):
     outfile = str(tmpdir.mkdir('out').join("buf-field.geojson"))
-    result = CliRunner().invoke(fio_buffer.core.buffer, [
+    result = runner.invoke(fio_buffer.core.buffer, [
         'tests/data/points.geojson',
         outfile,
         '--distance', 'distance',
         '--driver', 'GeoJSON'
     ])
     assert result.exit_code == 0
-    with fio.open('tests/data/points.geojson') as points, fio.open(outfile) as actual:
-        for pnt, buf in zip(points, actual):
-            dist = buf['properties']['distance']
-            e_coords = mapping(shape(pnt['geometry']).buffer(dist))['coordinates'][0]
-            a_coords = buf['geometry']['coordinates'][0]
-            for e_pair, a_pair in zip(e_coords, a_coords):
-                # Multipolygons can creep in and mess up the test so just skip them
-                if buf['geometry']['type'] == 'Polygon':
-                    e_x, e_y = e_pair
-                    a_x, a_y = a_pair
-                    assert round(e_x, 3) == round(a_x, 3)
-                    assert round(e_y, 3) == round(a_y, 3)
+    with fio.open(outfile) as actual:
+        distances = [pnt['properties']['distance'] for pnt in points]
+        for expected, buf in zip(buffer_all(points, distances), actual):
+            e_coords = shapely.get_coordinates(expected)
+            a_coords = shapely.get_coordinates(shape(buf['geometry']))
+            np.testing.assert_allclose(a_coords, e_coords, rtol=0, atol=1e-3)
 
 
-def test_buf_crs(tmpdir):
+def test_buf_crs(tmpdir, runner, points):
     outfile = str(tmpdir.mkdir('out').join("buf-field.geojson"))
-    result = CliRunner().invoke(fio_buffer.core.buffer, [
+    result = runner.invoke(fio_buffer.core.buffer, [
         'tests/data/points.geojson',
         outfile,
         '--distance', '100',
@@ -65,7 +70,7 @@ def test_buf_crs(tmpdir):
         '--buf-crs', 'EPSG:3857'
     ])
     assert result.exit_code == 0
-    with fio.open('tests/data/points.geojson') as points, fio.open(outfile) as actual:
+    with fio.open(outfile) as actual:
         for pnt, buf in zip(points, actual):
 
             # Reproject, buffer, reroject to create an expected geometry
@@ -74,18 +79,14 @@ def test_buf_crs(tmpdir):
             e_coords = transform_geom('EPSG:3857', 'EPSG:4326', buf_geom)['coordinates'][0]
 
             a_coords = buf['geometry']['coordinates'][0]
-            for e_pair, a_pair in zip(e_coords, a_coords):
-                # Multipolygons can creep in and mess up the test so just skip them
-                if buf['geometry']['type'] == 'Polygon':
-                    e_x, e_y = e_pair
-                    a_x, a_y = a_pair
-                    assert round(e_x, 3) == round(a_x, 3)
-                    assert round(e_y, 3) == round(a_y, 3)
+            # Multipolygons can creep in and mess up the test so just skip them
+            if buf['geometry']['type'] == 'Polygon':
+                np.testing.assert_allclose(a_coords, e_coords, rtol=0, atol=1e-3)
 
 
-def test_buf_dst_crs(tmpdir):
+def test_buf_dst_crs(tmpdir, runner, points):
     outfile = str(tmpdir.mkdir('out').join("buffered.geojson"))
-    result = CliRunner().invoke(fio_buffer.core.buffer, [
+    result = runner.invoke(fio_buffer.core.buffer, [
         'tests/data/points.geojson',
         outfile,
         '--distance', '100',
@@ -94,7 +95,7 @@ def test_buf_dst_crs(tmpdir):
         '--dst-crs', 'EPSG:900913'
     ])
     assert result.exit_code == 0
-    with fio.open('tests/data/points.geojson') as points, fio.open(outfile) as actual:
+    with fio.open(outfile) as actual:
         for pnt, buf in zip(points, actual):
 
             # Reproject, buffer, reroject to create an expected geometry
@@ -103,41 +104,33 @@ def test_buf_dst_crs(tmpdir):
             e_coords = transform_geom('EPSG:3857', 'EPSG:900913', buf_geom)['coordinates'][0]
 
             a_coords = buf['geometry']['coordinates'][0]
-            for e_pair, a_pair in zip(e_coords, a_coords):
-                # Multipolygons can creep in and mess up the test so just skip them
-                if buf['geometry']['type'] == 'Polygon':
-                    e_x, e_y = e_pair
-                    a_x, a_y = a_pair
-                    assert round(e_x, 3) == round(a_x, 3)
-                    assert round(e_y, 3) == round(a_y, 3)
+            # Multipolygons can creep in and mess up the test so just skip them
+            if buf['geometry']['type'] == 'Polygon':
+                np.testing.assert_allclose(a_coords, e_coords, rtol=0, atol=1e-3)
 
 
-def test_buffer_field(tmpdir):
+def test_buffer_field(tmpdir, runner, points, fixed7):
     outfile = str(tmpdir.mkdir('out').join('buf-field'))
-    result = CliRunner().invoke(fio_buffer.core.buffer, [
+    result = runner.invoke(fio_buffer.core.buffer, [
         'tests/data/points.geojson',
         outfile,
         '--distance', 'distance',
     ])
     assert result.exit_code == 0
-    with fio.open('tests/data/points.geojson') as src, fio.open(outfile) as out:
-        assert len(src) == len(out) and len(src) > 1
-        for e, a in zip(src, out):
+    with fio.open(outfile) as out:
+        assert len(points) == len(out) and len(points) > 1
+        expected = buffer_all(points, [e['properties']['distance'] for e in points])
+        for e, a, e_geom in zip(points, out, expected):
             assert e['properties'] == a['properties']
-            e_coords = mapping(
-                shape(e['geometry']).buffer(e['properties']['distance']))['coordinates'][0]
-            a_coords = a['geometry']['coordinates'][0]
-            for e_pair, a_pair in zip(e_coords, a_coords):
-                e_x, e_y = e_pair
-                a_x, a_y = a_pair
-                assert round(e_x, 7) == round(a_x, 7)
-                assert round(e_y, 7) == round(a_y, 7)
+            e_coords = shapely.get_coordinates(e_geom)
+            a_coords = shapely.get_coordinates(shape(a['geometry']))
+            assert np.array_equal(fixed7(a_coords), fixed7(e_coords))
 
 
-def test_register():
+def test_register(runner):
     # Make sure the plugin is actually registering
     assert 'buffer' in fiona.fio.main.main_group.commands
-    result = CliRunner().invoke(
+    result = runner.invoke(
         fiona.fio.main.main_group, [
             'buffer',
             '--help'
@@ -146,15 +139,216 @@ def test_register():
     assert result.exit_code == 0
 
 
-def test_inherit_driver(tmpdir):
+def test_lazy_imports():
+    # Fiona loads every plugin when `fio` starts, so importing the plugin
+    # must not import the geometry libraries
+    code = (
+        "import sys, fio_buffer.core; "
+        "print(sorted(m for m in ('numpy', 'orjson', 'pyproj', 'shapely') if m in sys.modules))")
+    output = subprocess.check_output([sys.executable, '-c', code])
+    assert output.strip() == b'[]'
+
+
+def test_inherit_driver(tmpdir, runner, points, points_meta):
     outfile = str(tmpdir.mkdir('out').join("inherit-driver.geojson"))
-    result = CliRunner().invoke(fio_buffer.core.buffer, [
+    result = runner.invoke(fio_buffer.core.buffer, [
+        'tests/data/points.geojson',
+        outfile,
+        '--distance', '1',
+    ])
+    assert result.exit_code == 0
+    with fio.open(outfile) as out:
+        assert points_meta['driver'] == out.driver == 'GeoJSON'
+        assert points_meta['crs'] == out.crs == {'init': 'epsg:4326'}
+        assert len(points) == len(out) and len(points) > 1
+
+
+def test_prefetch(tmpdir, runner, monkeypatch, points):
+    # Force several batches through a minimal prefetch window
+    monkeypatch.setattr(fio_buffer.core, '_BATCH_SIZE', 10)
+    outfile = str(tmpdir.mkdir('out').join("prefetch.geojson"))
+    result = runner.invoke(fio_buffer.core.buffer, [
+        'tests/data/points.geojson',
+        outfile,
+        '--distance', '1',
+        '--prefetch', '1',
+        '--geom-type', 'Unknown'
+    ])
+    assert result.exit_code == 0
+    with fio.open(outfile) as out:
+        assert len(points) == len(out) and len(points) > 10
+
+
+def test_distance_field_null(tmpdir, runner, points, points_meta):
+    # Features without a distance are written unaltered and in order
+    infile = str(tmpdir.join("null-distance.geojson"))
+    outfile = str(tmpdir.mkdir('out').join("null-distance.geojson"))
+    with fio.open(infile, 'w', **points_meta) as dst:
+        for idx, feat in enumerate(points):
+            if idx % 3 == 0:
+                feat = {
+                    'type': 'Feature',
+                    'properties': {'distance': None},
+                    'geometry': feat['geometry']
+                }
+            dst.write(feat)
+
+    result = runner.invoke(fio_buffer.core.buffer, [
+        infile,
+        outfile,
+        '--distance', 'distance',
+        '--geom-type', 'Unknown'
+    ])
+    assert result.exit_code == 0
+    with fio.open(infile) as src, fio.open(outfile) as out:
+        assert len(src) == len(out)
+        for e, a in zip(src, out):
+            if e['properties']['distance'] is None:
+                assert e['geometry']['type'] == a['geometry']['type'] == 'Point'
+                assert e['geometry']['coordinates'] == a['geometry']['coordinates']
+            else:
+                assert a['geometry']['type'] != 'Point'
+
+
+def test_write_batch(tmpdir, runner, points):
+    outfile = str(tmpdir.mkdir('out').join("write-batch.geojson"))
+    result = runner.invoke(fio_buffer.core.buffer, [
         'tests/data/points.geojson',
         outfile,
         '--distance', '1',
+        '--write-batch', '7',
+        '--geom-type', 'Unknown'
     ])
     assert result.exit_code == 0
-    with fio.open('tests/data/points.geojson') as src, fio.open(outfile) as out:
-        assert src.driver == out.driver == 'GeoJSON'
-        assert src.crs == out.crs == {'init': 'epsg:4326'}
-        assert len(src) == len(out) and len(src) > 1
+    with fio.open(outfile) as out:
+        assert len(points) == len(out) and len(points) > 7
+
+
+def test_transaction(tmpdir, runner, points):
+    outdir = tmpdir.mkdir('out')
+    for flags in ([], ['--no-transaction']):
+        outfile = str(outdir.join("transaction-%s.gpkg" % len(flags)))
+        result = runner.invoke(fio_buffer.core.buffer, [
+            'tests/data/points.geojson',
+            outfile,
+            '--distance', '1',
+            '--driver', 'GPKG',
+            '--geom-type', 'Unknown',
+            '--write-batch', '7'
+        ] + flags)
+        assert result.exit_code == 0
+        with fio.open(outfile) as out:
+            assert len(points) == len(out) and len(points) > 7
+
+
+def test_transaction_write_failure(tmpdir, runner, caplog):
+    # Write failures are logged before being raised
+    outfile = str(tmpdir.mkdir('out').join("failed.gpkg"))
+    result = runner.invoke(fio_buffer.core.buffer, [
+        'tests/data/points.geojson',
+        outfile,
+        '--distance', '1',
+        '--driver', 'GPKG',
+        '--geom-type', 'Point'
+    ])
+    assert result.exit_code != 0
+    assert "failed during write" in caplog.text
+
+
+def test_seq(tmpdir, runner, points):
+    outfile = str(tmpdir.mkdir('out').join("buf.geojsons"))
+    result = runner.invoke(fio_buffer.core.buffer, [
+        'tests/data/points.geojson',
+        outfile,
+        '--distance', 'distance',
+        '--write-batch', '7',
+        '--seq'
+    ])
+    assert result.exit_code == 0
+
+    with open(outfile) as f:
+        text = f.read()
+    assert text.startswith('\x1e') and text.endswith('\n')
+    records = [json.loads(r) for r in text.split('\x1e')[1:]]
+
+    # Fiona reads GeoJSON text sequences too
+    with fio.open(outfile) as out:
+        assert len(points) == len(records) == len(out)
+        expected = buffer_all(points, [e['properties']['distance'] for e in points])
+        for e, a, record, e_geom in zip(points, out, records, expected):
+            assert record['type'] == 'Feature'
+            assert record['properties'] == dict(e['properties'])
+            assert shape(a['geometry']).symmetric_difference(e_geom).area < 1e-7
+
+
+def test_write_geojson(tmpdir, runner, points):
+    # GeoJSON is written without Fiona but must read back the same
+    outdir = tmpdir.mkdir('out')
+    for dst_crs in ('EPSG:4326', 'EPSG:3857'):
+        outfile = str(outdir.join('buf-%s.geojson' % dst_crs[5:]))
+        result = runner.invoke(fio_buffer.core.buffer, [
+            'tests/data/points.geojson',
+            outfile,
+            '--distance', '1',
+            '--buf-crs', 'EPSG:3857',
+            '--dst-crs', dst_crs,
+            '--geom-type', 'Unknown'
+        ])
+        assert result.exit_code == 0
+        with fio.open(outfile) as out:
+            assert out.driver == 'GeoJSON'
+            assert len(points) == len(out)
+            assert out.crs.to_epsg() == fio.crs.CRS.from_user_input(dst_crs).to_epsg()
+            for e, a in zip(points, out):
+                assert e['properties'] == a['properties']
+
+
+def test_write_failure(tmpdir, runner, monkeypatch):
+    # A failure partway through the directly written formats doesn't leave
+    # truncated output behind
+    calls = []
+
+    def process_batch(batch):
+        calls.append(batch)
+        if len(calls) == 3:
+            raise RuntimeError("failed on purpose")
+        return fio_buffer.core._processor_batch(batch)
+
+    monkeypatch.setattr(fio_buffer.core, '_BATCH_SIZE', 10)
+    monkeypatch.setattr(fio_buffer.core, '_process_batch', process_batch)
+    outdir = tmpdir.mkdir('out')
+    for flags in (['--geom-type', 'Unknown'], ['--seq']):
+        del calls[:]
+        outfile = str(outdir.join('failed-%s.geojson' % len(flags)))
+        result = runner.invoke(fio_buffer.core.buffer, [
+            'tests/data/points.geojson',
+            outfile,
+            '--distance', '1',
+            '--jobs', '1',
+            '--write-batch', '1'
+        ] + flags)
+        assert result.exit_code != 0
+        assert len(calls) == 3
+        assert not outdir.join('failed-%s.geojson' % len(flags)).exists()
+
+
+def test_write_fiona(tmpdir, runner, points):
+    # Polygons are promoted to the default MultiPolygon geometry type for
+    # formats Fiona writes
+    outdir = tmpdir.mkdir('out')
+    expected = buffer_all(points, [e['properties']['distance'] for e in points])
+    for driver, name in (('ESRI Shapefile', 'buf.shp'), ('GPKG', 'buf.gpkg')):
+        outfile = str(outdir.join(name))
+        result = runner.invoke(fio_buffer.core.buffer, [
+            'tests/data/points.geojson',
+            outfile,
+            '--distance', 'distance',
+            '--driver', driver
+        ])
+        assert result.exit_code == 0
+        with fio.open(outfile) as out:
+            assert len(points) == len(out)
+            if driver == 'GPKG':
+                assert out.schema['geometry'] == 'MultiPolygon'
+            for a, e_geom in zip(out, expected):
+                assert shape(a['geometry']).symmetric_difference(e_geom).area < 1e-7
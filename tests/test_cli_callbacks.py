@@ -7,15 +7,22 @@ import fio_buffer.core
 
 
 def test_cb_cap_style():
-    cap_styles = {a: getattr(CAP_STYLE, a) for a in dir(CAP_STYLE) if not a.startswith('_')}
-    for style, val in cap_styles.items():
-        assert fio_buffer.core._cb_cap_style(None, None, style) == val
+    assert set(fio_buffer.core.CAP_STYLES) >= {'flat', 'round', 'square'}
+    for style, val in fio_buffer.core.CAP_STYLES.items():
+        assert fio_buffer.core._cb_cap_style(None, None, style) == val == getattr(CAP_STYLE, style)
 
 
 def test_cb_join_style():
-    join_styles = {a: getattr(JOIN_STYLE, a) for a in dir(JOIN_STYLE) if not a.startswith('_')}
-    for style, val in join_styles.items():
-        assert fio_buffer.core._cb_join_style(None, None, style) == val
+    assert set(fio_buffer.core.JOIN_STYLES) >= {'round', 'mitre', 'bevel'}
+    for style, val in fio_buffer.core.JOIN_STYLES.items():
+        assert fio_buffer.core._cb_join_style(None, None, style) == val == getattr(JOIN_STYLE, style)
+
+
+def test_cb_style_bad_value():
+    with pytest.raises(click.BadParameter):
+        fio_buffer.core._cb_cap_style(None, None, 'mitre')
+    with pytest.raises(click.BadParameter):
+        fio_buffer.core._cb_join_style(None, None, 'flat')
 
 def test_cb_res():
     assert fio_buffer.core._cb_res(None, None, 1) == 1
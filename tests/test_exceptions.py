@@ -1,10 +1,8 @@
-from click.testing import CliRunner
-
 import fio_buffer.core
 
 
-def test_dst_crs_no_buf_crs():
-    result = CliRunner().invoke(fio_buffer.core.buffer, [
+def test_dst_crs_no_buf_crs(runner):
+    result = runner.invoke(fio_buffer.core.buffer, [
         'tests/data/points.geojson',
         'should-not-be-written',
         '--driver', 'GeoJSON',
@@ -12,3 +10,13 @@ def test_dst_crs_no_buf_crs():
         '--dst-crs', 'EPSG:3857'
     ])
     assert result.exit_code != 0
+
+
+def test_distance_bad_field(runner):
+    result = runner.invoke(fio_buffer.core.buffer, [
+        'tests/data/points.geojson',
+        'should-not-be-written',
+        '--distance', 'not-a-field'
+    ])
+    assert result.exit_code != 0
+    assert '--distance' in result.output
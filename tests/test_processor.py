@@ -1,4 +1,12 @@
+from concurrent.futures import ProcessPoolExecutor
 import copy
+import itertools
+import json
+
+from fiona.errors import TransformError
+from fiona.transform import transform_geom
+import numpy as np
+import pytest
 
 from shapely.geometry import mapping
 from shapely.geometry import shape
@@ -16,45 +24,29 @@ feature = {
 }
 
 
-def round7(val):
-    return round(val, 7)
-
-
-def test_just_buffer():
-    args = {
-        'feat': feature,
-        'src_crs': None,
-        'buf_crs': None,
-        'dst_crs': None,
-        'skip_failures': False,
-        'buf_args': {'distance': 10},
-    }
+def test_just_buffer(fixed7):
+    buf_args = {'distance': 10}
+    fio_buffer.core._init(None, None, None, False, buf_args)
 
     expected = {
         'type': 'Feature',
         'properties': feature['properties'],
-        'geometry': mapping(shape(feature['geometry']).buffer(**args['buf_args']))
+        'geometry': mapping(shape(feature['geometry']).buffer(**buf_args))
     }
 
-    actual = fio_buffer.core._processor(args)
+    actual, = fio_buffer.core._processor_batch([feature])
 
     assert expected.keys() == actual.keys()
     assert expected['properties'] == actual['properties']
 
-    for a_pair, e_pair in zip(
-            expected['geometry']['coordinates'][0], actual['geometry']['coordinates'][0]):
-        assert list(map(round7, a_pair)) == list(map(round7, e_pair))
+    assert np.array_equal(
+        fixed7(actual['geometry']['coordinates'][0]),
+        fixed7(expected['geometry']['coordinates'][0]))
 
 
-def test_buffer_field():
-    args = {
-        'feat': feature,
-        'src_crs': None,
-        'buf_crs': None,
-        'dst_crs': None,
-        'skip_failures': False,
-        'buf_args': {'distance': 'prop1'},
-    }
+def test_buffer_field(fixed7):
+    buf_args = {'distance': 'prop1'}
+    fio_buffer.core._init(None, None, None, False, buf_args)
 
     expected = {
         'type': 'Feature',
@@ -62,33 +54,330 @@ def test_buffer_field():
         'geometry': mapping(shape(feature['geometry']).buffer(distance=1))
     }
 
-    actual = fio_buffer.core._processor(args)
+    actual, = fio_buffer.core._processor_batch([feature])
 
     assert expected.keys() == actual.keys()
     assert expected['properties'] == actual['properties']
 
-    for a_pair, e_pair in zip(
-            expected['geometry']['coordinates'][0], actual['geometry']['coordinates'][0]):
-        assert list(map(round7, a_pair)) == list(map(round7, e_pair))
+    assert np.array_equal(
+        fixed7(actual['geometry']['coordinates'][0]),
+        fixed7(expected['geometry']['coordinates'][0]))
 
 
-def test_buffer_field_no_val():
+def test_buffer_field_no_val(fixed7):
     # Buffer by a field where the distance is None
-    args = {
-        'feat': feature,
-        'src_crs': None,
-        'buf_crs': None,
-        'dst_crs': None,
-        'skip_failures': False,
-        'buf_args': {'distance': 'prop2'},
-    }
+    buf_args = {'distance': 'prop2'}
+    fio_buffer.core._init(None, None, None, False, buf_args)
 
     expected = copy.deepcopy(feature)
-    actual = fio_buffer.core._processor(args)
+    actual, = fio_buffer.core._processor_batch([feature])
 
     assert expected.keys() == actual.keys()
     assert expected['properties'] == actual['properties']
 
-    for a_pair, e_pair in zip(
-            expected['geometry']['coordinates'][0], actual['geometry']['coordinates'][0]):
-        assert list(map(round7, a_pair)) == list(map(round7, e_pair))
\ No newline at end of file
+    assert np.array_equal(
+        fixed7(actual['geometry']['coordinates'][0]),
+        fixed7(expected['geometry']['coordinates'][0]))
+
+def test_mapping():
+    geom = shape(feature['geometry'])
+    polygon = geom.buffer(10).difference(geom)
+    multipolygon = polygon.union(geom.buffer(-0.5))
+    empty = geom.buffer(-10)
+    for geom in (polygon, multipolygon, empty):
+        expected = mapping(geom)
+        actual = fio_buffer.core._mapping(geom)
+        assert expected['type'] == actual['type']
+        assert shape(expected).equals(shape(actual))
+
+
+def test_dumps():
+    # Polygon rings are serialized straight from coordinate arrays
+    pytest.importorskip('shapely', minversion='2')
+    geom = shape(feature['geometry']).buffer(10)
+    rings = fio_buffer.core._mapping(geom, arrays=True)['coordinates']
+    assert all(isinstance(r, np.ndarray) for r in rings)
+    actual = json.loads(fio_buffer.core._dumps({'geometry': geom}))
+    assert shape(actual['geometry']).equals_exact(geom, 1e-12)
+
+
+def test_reproject():
+    buf_args = {'distance': 10}
+    fio_buffer.core._init('EPSG:4326', 'EPSG:3857', 'EPSG:32618', False, buf_args)
+
+    geom = transform_geom('EPSG:4326', 'EPSG:3857', feature['geometry'])
+    geom = mapping(shape(geom).buffer(**buf_args))
+    expected = transform_geom('EPSG:3857', 'EPSG:32618', geom)
+
+    actual, = fio_buffer.core._processor_batch([feature])
+
+    assert shape(actual['geometry']).equals_exact(shape(expected), 1e-3)
+
+
+def test_reproject_out_of_domain():
+    # Coordinates outside of the destination CRS' domain fail instead of
+    # being written as infinity
+    pyproj = pytest.importorskip('pyproj')
+    feat = dict(feature, geometry={'type': 'Point', 'coordinates': [14.59, 0.71]})
+    buf_args = {'distance': 100}
+
+    fio_buffer.core._init('EPSG:4326', 'EPSG:3857', 'EPSG:32618', False, buf_args)
+    with pytest.raises(pyproj.exceptions.ProjError):
+        fio_buffer.core._processor_batch([feat])
+
+    fio_buffer.core._init('EPSG:4326', 'EPSG:3857', 'EPSG:32618', True, buf_args)
+    assert fio_buffer.core._processor_batch([feat, feature])[0] is None
+
+
+def test_gdal_env(points):
+    # Features are processed with the GDAL configuration given to `_init()`
+    buf_args = {'distance': 100000}
+    feat = points[8]
+
+    fio_buffer.core._init(
+        'EPSG:4326', 'EPSG:3857', 'EPSG:4326', False, buf_args,
+        gdal_env={'CHECK_WITH_INVERT_PROJ': True})
+    with pytest.raises(TransformError):
+        fio_buffer.core._processor_batch([feat])
+
+    fio_buffer.core._init(
+        'EPSG:4326', 'EPSG:3857', 'EPSG:4326', False, buf_args,
+        gdal_env={'CHECK_WITH_INVERT_PROJ': False})
+    actual, = fio_buffer.core._processor_batch([feat])
+    assert actual['properties'] == feat['properties']
+
+
+def test_antimeridian():
+    # Geographic output is cut at the antimeridian even without reprojecting
+    crossing = {'type': 'Feature', 'properties': {},
+                'geometry': {'type': 'Point', 'coordinates': [179.9, 10]}}
+    inside = {'type': 'Feature', 'properties': {},
+              'geometry': {'type': 'Point', 'coordinates': [10, 10]}}
+    buf_args = {'distance': 0.3, 'cap_style': 3}
+    for geo_interface in (False, True):
+        fio_buffer.core._init(
+            'EPSG:4326', 'EPSG:4326', 'EPSG:4326', False, buf_args,
+            geo_interface=geo_interface)
+        actual, = fio_buffer.core._processor_batch([crossing])
+        geom = shape(actual['geometry'])
+        assert geom.geom_type == 'MultiPolygon'
+        assert geom.bounds == pytest.approx((-180, 9.7, 180, 10.3))
+
+        actual, = fio_buffer.core._processor_batch([inside])
+        assert shape(actual['geometry']).equals(shape(inside['geometry']).buffer(0.3, cap_style=3))
+
+
+def test_geo_interface():
+    buf_args = {'distance': 10}
+    fio_buffer.core._init(None, None, None, False, buf_args, geo_interface=True)
+
+    actual = fio_buffer.core._processor(feature)
+
+    assert not isinstance(actual['geometry'], dict)
+    assert actual['geometry'].equals(shape(feature['geometry']).buffer(10))
+
+
+def test_transformer_cache():
+    pytest.importorskip('pyproj')
+    first = fio_buffer.core._transformer('EPSG:4326', 'EPSG:3857')
+    assert fio_buffer.core._transformer('EPSG:4326', 'EPSG:3857') is first
+    assert fio_buffer.core._transformer('EPSG:3857', 'EPSG:32618') is not first
+
+    # Geographic output needs `transform_geom()` for antimeridian cutting
+    assert fio_buffer.core._transformer('EPSG:3857', 'EPSG:4326') is None
+
+
+def test_batch_size():
+    batch_size = fio_buffer.core._BATCH_SIZE
+    assert fio_buffer.core._batch_size(range(100000), 2) == batch_size
+    assert fio_buffer.core._batch_size(range(160), 2) == 10
+    assert fio_buffer.core._batch_size(range(3), 2) == 1
+    assert fio_buffer.core._batch_size(iter(range(100000)), 2) == batch_size
+
+
+def test_buffer_is_empty():
+    # Negative distances on geometries without area and erosions wider than
+    # the geometry short circuit to an empty polygon
+    point = {'type': 'Feature', 'properties': {},
+             'geometry': {'type': 'Point', 'coordinates': [0, 0]}}
+    for feat, distance in ((point, 0), (point, -1), (feature, -1), (feature, -10)):
+        fio_buffer.core._init(None, None, None, False, {'distance': distance})
+        actual = fio_buffer.core._processor(feat)
+        assert shape(actual['geometry']).is_empty
+        assert shape(feat['geometry']).buffer(distance).is_empty
+
+
+def test_fuse_buffers():
+    # Disjoint buffers are fused, overlapping buffers fall back to individual
+    # buffers, and both must match buffering each feature on its own
+    pytest.importorskip('shapely', minversion='2')
+
+    def point(x, y):
+        return {'type': 'Feature', 'properties': {},
+                'geometry': {'type': 'Point', 'coordinates': [x, y]}}
+
+    # A multipart input buffered into two parts, one of which merges with the
+    # buffer of another input, has as many parts as inputs but can't be fused
+    multipoint = {'type': 'Feature', 'properties': {},
+                  'geometry': {'type': 'MultiPoint', 'coordinates': [[0, 0], [10, 0]]}}
+
+    for batch in ([point(0, 0), point(10, 10), point(20, 0)],
+                  [point(0, 0), point(1, 1), point(20, 0)],
+                  [multipoint, point(11, 0)]):
+        processor = fio_buffer.core._make_processor(
+            None, None, None, False, {'distance': 2}, fuse_buffers=True)
+        for feat, actual in zip(batch, processor(batch)):
+            expected = shape(feat['geometry']).buffer(2)
+            assert shape(actual['geometry']).symmetric_difference(expected).area < 1e-7
+
+
+def test_buffer_field_batch():
+    # The distance from one feature must not leak into the next
+    batch = [dict(feature, properties={'prop1': d}) for d in (1, 2, 3)]
+    processor = fio_buffer.core._make_processor(None, None, None, False, {'distance': 'prop1'})
+    for feat, actual in zip(batch, processor(batch)):
+        expected = shape(feat['geometry']).buffer(feat['properties']['prop1'])
+        assert shape(actual['geometry']).symmetric_difference(expected).area < 1e-7
+
+
+def test_available_cpus(monkeypatch):
+    assert 1 <= fio_buffer.core._available_cpus() <= fio_buffer.core.cpu_count()
+
+    # CPU affinity limits are respected
+    if hasattr(fio_buffer.core.os, 'sched_getaffinity'):
+        monkeypatch.setattr(fio_buffer.core.os, 'sched_getaffinity', lambda pid: {3})
+        assert fio_buffer.core._available_cpus() == 1
+
+
+def test_read_ahead():
+    assert list(fio_buffer.core._read_ahead(range(100), 3)) == list(range(100))
+
+    def fail():
+        yield 1
+        raise ValueError("failed")
+
+    items = fio_buffer.core._read_ahead(fail(), 3)
+    assert next(items) == 1
+    with pytest.raises(ValueError):
+        next(items)
+
+    # Stopping early stops the producer
+    items = fio_buffer.core._read_ahead(itertools.count(), 3)
+    assert next(items) == 0
+    items.close()
+
+
+def test_shape_points():
+    pytest.importorskip('shapely', minversion='2')
+    points = [{'type': 'Point', 'coordinates': [x, -x]} for x in range(5)]
+    actual = fio_buffer.core._shape_points(points)
+    assert [mapping(p)['coordinates'] for p in actual] == [(x, -x) for x in range(5)]
+
+    # Anything other than consistent points is left to `shape()`
+    assert fio_buffer.core._shape_points(points + [feature['geometry']]) is None
+    assert fio_buffer.core._shape_points(
+        points + [{'type': 'Point', 'coordinates': [1, 2, 3]}]) is None
+
+
+def test_process_batch():
+    # Workers receive stripped features and only return geometries
+    feat = dict(feature, id='1', properties={'prop1': 1, 'prop2': 'ignored'})
+    stripped = fio_buffer.core._strip(feat, 'prop1')
+    assert stripped == {'id': '1', 'geometry': feat['geometry'], 'properties': {'prop1': 1}}
+
+    fio_buffer.core._init(None, None, None, False, {'distance': 'prop1'})
+    actual, = fio_buffer.core._process_batch([stripped])
+    expected = shape(feat['geometry']).buffer(1)
+    assert shape(actual).symmetric_difference(expected).area < 1e-7
+
+
+def test_as_multipolygon():
+    polygon = shape(feature['geometry'])
+    for geom in (feature['geometry'], polygon):
+        actual = fio_buffer.core._as_multipolygon(dict(feature, geometry=geom))
+        assert actual['properties'] == feature['properties']
+        assert shape(actual['geometry']).geom_type == 'MultiPolygon'
+        assert shape(actual['geometry']).equals(polygon)
+
+    # Everything else is left alone
+    point = dict(feature, geometry={'type': 'Point', 'coordinates': [0, 0]})
+    assert fio_buffer.core._as_multipolygon(point) is point
+
+
+def test_pool_results():
+    # Batches come back from a real pool in order and match processing them
+    # in-process, including features without a distance and batches with
+    # nothing to buffer
+    feats = [
+        dict(feature, id=str(i), properties={'prop1': d, 'prop2': i})
+        for i, d in enumerate([1, None, 0.5, 2, None, None, 3, -0.25, 1.5])]
+    batches = list(fio_buffer.core._chunked(feats, 2)) + [[feats[1]]]
+    get_distance = fio_buffer.core._distance_getter('prop1')
+
+    def has_distance(feat):
+        return get_distance(feat) is not None
+
+    buf_args = {'distance': 'prop1'}
+    fio_buffer.core._init(None, None, None, False, buf_args)
+    expected = [
+        fio_buffer.core._merge(
+            batch,
+            fio_buffer.core._process_batch([f for f in batch if has_distance(f)]),
+            has_distance)
+        for batch in batches]
+
+    with ProcessPoolExecutor(
+            2, mp_context=fio_buffer.core._mp_context(),
+            initializer=fio_buffer.core._init,
+            initargs=(None, None, None, False, buf_args)) as executor:
+        for prefetch in (1, 3):
+            actual = list(fio_buffer.core._pool_results(
+                executor, iter(batches), prefetch, has_distance, 'prop1'))
+            assert len(actual) == len(expected)
+            for a_batch, e_batch in zip(actual, expected):
+                assert [f['id'] for f in a_batch] == [f['id'] for f in e_batch]
+                for a, e in zip(a_batch, e_batch):
+                    assert a['properties'] == e['properties']
+                    assert shape(a['geometry']).equals(shape(e['geometry']))
+
+
+def test_processor_batch():
+    # Vectorized and per-feature paths are mixed in a single batch without
+    # changing the order of the features
+    batch = [dict(feature, properties={'prop1': d}) for d in (1, None, -0.5, 2, 0)]
+    fio_buffer.core._init(None, None, None, False, {'distance': 'prop1'})
+    actual = fio_buffer.core._processor_batch(batch)
+    assert len(actual) == len(batch)
+    for feat, o_feat in zip(batch, actual):
+        assert o_feat['properties'] == feat['properties']
+        distance = feat['properties']['prop1'] or 0
+        expected = shape(feat['geometry']).buffer(distance)
+        assert shape(o_feat['geometry']).symmetric_difference(expected).area < 1e-7
+
+
+def test_buffer_points():
+    shapely = pytest.importorskip('shapely', minversion='2')
+    points = shapely.points([[0, 0], [-1e5, 3.5], [12.25, 1e6]])
+    distances = np.array([1, 0.001, 250])
+    for quad_segs in (0, 1, 8, 16):
+        expected = shapely.buffer(points, distances, quad_segs=quad_segs)
+        actual = fio_buffer.core._buffer_points(points, distances, quad_segs)
+        assert shapely.equals_exact(actual, expected, 1e-7).all()
+
+    # GEOS handles anything that isn't a plain 2D point
+    assert fio_buffer.core._buffer_points(
+        shapely.points([[0, 0, 0]]), distances[:1], 16) is None
+
+
+def test_kernels_buffer_points():
+    # The loop compiled by Numba and the numpy fallback must agree
+    from fio_buffer import _kernels
+    x, y, distances = np.array([[0, -1e5, 12.25], [0, 3.5, 1e6], [1, 0.001, 250]])
+    theta = np.linspace(0, -2 * np.pi, 17)
+    circle = np.column_stack([np.cos(theta), np.sin(theta)])
+    expected = _kernels._buffer_points_numpy(x, y, distances, circle)
+    assert expected.shape == (3, 17, 2)
+    np.testing.assert_array_equal(
+        _kernels._buffer_points_loop(x, y, distances, circle), expected)
+    np.testing.assert_allclose(
+        _kernels.buffer_points(x, y, distances, circle), expected, rtol=0, atol=1e-7)